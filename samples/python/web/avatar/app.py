@@ -2,11 +2,13 @@
 # Licensed under the MIT license.
 
 import azure.cognitiveservices.speech as speechsdk
+import collections
 import datetime
+import functools
 import html
 import json
 import os
-import pytz
+import queue
 import random
 import re
 import requests
@@ -40,15 +42,35 @@ ice_server_password = os.environ.get('ICE_SERVER_PASSWORD') # The ICE password
 
 # Const variables
 default_tts_voice = 'en-US-JennyMultilingualV2Neural' # Default TTS voice
-sentence_level_punctuations = [ '.', '?', '!', ':', ';', '。', '？', '！', '：', '；' ] # Punctuations that indicate the end of a sentence
+sentence_level_punctuations = frozenset([ '.', '?', '!', ':', ';', '。', '？', '！', '：', '；' ]) # Punctuations that indicate the end of a sentence
 enable_quick_reply = False # Enable quick reply for certain chat models which take longer time to respond
 quick_replies = [ 'Let me take a look.', 'Let me check.', 'One moment, please.' ] # Quick reply reponses
 oyd_doc_regex = re.compile(r'\[doc(\d+)\]') # Regex to match the OYD (on-your-data) document reference
+speaking_pipeline_depth = 2 # Max number of utterances submitted to the synthesizer at a time, so the next one is submitted while the current one is being spoken
+speech_synthesis_done_marker = object() # Put on a speaking thread's queue when one of its utterances is completed or canceled
+speaking_stopped_marker = object() # Put on a speaking thread's queue by stop speaking, to drop the texts held by the thread
+max_chat_history_turns = 20 # Max number of recent turns (user query and the replies to it) kept in chat history and sent to chat API
+chat_response_flush_size = 64 # Flush the buffered chat response tokens to client once they reach this many characters
+# Pre-serialized avatar config, the string placeholders take JSON encoded values (json.dumps)
+avatar_config_template = ('{"synthesis": {"video": {'
+                              '"protocol": {"name": "WebRTC", "webrtcConfig": {'
+                                  '"clientDescription": %(local_sdp)s, '
+                                  '"iceServers": [{"urls": [%(ice_url)s], "username": %(ice_username)s, "credential": %(ice_password)s}]}}, '
+                              '"format": {"crop": {"topLeft": {"x": %(crop_left)d, "y": 0}, "bottomRight": {"x": %(crop_right)d, "y": 1080}}, "bitrate": 2000000}, '
+                              '"talkingAvatar": {"customized": %(customized)s, "character": %(character)s, "style": %(style)s, "background": {"color": %(background_color)s}}'
+                          '}}}')
 
 # Global variables
 client_contexts = {} # Client contexts
+speaking_thread_lock = threading.Lock() # Lock to guard starting and stopping the speaking thread of a client, together with its queue
+aoai_session = requests.Session() # HTTP session shared by all chat requests, which keeps the connections to Azure OpenAI alive
+aoai_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=100))
+aoai_request_headers = { 'api-key': azure_openai_api_key, 'Content-Type': 'application/json' } # Request headers for Azure OpenAI chat API
 speech_token = None # Speech token
+speech_token_ready = threading.Event() # Event set once the first speech token is fetched
+sts_session = requests.Session() # HTTP session for speech token requests, which keeps the connection to the token service alive
 ice_token = None # ICE token
+ice_token_parsed = None # ICE server URL, username and password parsed from the ICE token
 
 # The default route, which shows the default web page (basic.html)
 @app.route("/")
@@ -69,6 +91,8 @@ def chatView():
 @app.route("/api/getSpeechToken", methods=["GET"])
 def getSpeechToken() -> Response:
     global speech_token
+    # Wait for the first token, in case this is called right after startup
+    speech_token_ready.wait(timeout=5)
     response = Response(speech_token, status=200)
     response.headers['SpeechRegion'] = speech_region
     return response
@@ -84,6 +108,8 @@ def getIceToken() -> Response:
             'Password': ice_server_password
         })
         return Response(custom_ice_token, status=200)
+    if ice_token is None:
+        return Response('ICE token is not available yet, please retry later.', status=400)
     return Response(ice_token, status=200)
 
 # The API route to connect the TTS avatar
@@ -101,6 +127,7 @@ def connectAvatar() -> Response:
     client_context['personal_voice_speaker_profile_id'] = request.headers.get('PersonalVoiceSpeakerProfileId')
 
     custom_voice_endpoint_id = client_context['custom_voice_endpoint_id']
+    client_context['ssml_template'] = buildSsmlTemplate(client_context['tts_voice'], client_context['personal_voice_speaker_profile_id'])
 
     try:
         if speech_private_endpoint:
@@ -115,14 +142,15 @@ def connectAvatar() -> Response:
         client_context['speech_synthesizer'] = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
         speech_synthesizer = client_context['speech_synthesizer']
         
-        ice_token_obj = json.loads(ice_token)
         # Apply customized ICE server if provided
         if ice_server_url and ice_server_username and ice_server_password:
-            ice_token_obj = {
-                'Urls': [ ice_server_url_remote ] if ice_server_url_remote else [ ice_server_url ],
-                'Username': ice_server_username,
-                'Password': ice_server_password
-            }
+            ice_url = ice_server_url_remote if ice_server_url_remote else ice_server_url
+            ice_username = ice_server_username
+            ice_password = ice_server_password
+        else:
+            if ice_token_parsed is None:
+                return Response('ICE token is not available yet, please retry later.', status=400)
+            ice_url, ice_username, ice_password = ice_token_parsed
         local_sdp = request.headers.get('LocalSdp')
         avatar_character = request.headers.get('AvatarCharacter')
         avatar_style = request.headers.get('AvatarStyle')
@@ -130,47 +158,21 @@ def connectAvatar() -> Response:
         is_custom_avatar = request.headers.get('IsCustomAvatar')
         transparent_background = 'false' if request.headers.get('TransparentBackground') is None else request.headers.get('TransparentBackground')
         video_crop = 'false' if request.headers.get('VideoCrop') is None else request.headers.get('VideoCrop')
-        avatar_config = {
-            'synthesis': {
-                'video': {
-                    'protocol': {
-                        'name': "WebRTC",
-                        'webrtcConfig': {
-                            'clientDescription': local_sdp,
-                            'iceServers': [{
-                                'urls': [ ice_token_obj['Urls'][0] ],
-                                'username': ice_token_obj['Username'],
-                                'credential': ice_token_obj['Password']
-                            }]
-                        },
-                    },
-                    'format':{
-                        'crop':{
-                            'topLeft':{
-                                'x': 600 if video_crop.lower() == 'true' else 0,
-                                'y': 0
-                            },
-                            'bottomRight':{
-                                'x': 1320 if video_crop.lower() == 'true' else 1920,
-                                'y': 1080
-                            }
-                        },
-                        'bitrate': 2000000
-                    },
-                    'talkingAvatar': {
-                        'customized': is_custom_avatar.lower() == 'true',
-                        'character': avatar_character,
-                        'style': avatar_style,
-                        'background': {
-                            'color': '#00FF00FF' if transparent_background.lower() == 'true' else background_color
-                        }
-                    }
-                }
-            }
+        avatar_config = avatar_config_template % {
+            'local_sdp': json.dumps(local_sdp),
+            'ice_url': json.dumps(ice_url),
+            'ice_username': json.dumps(ice_username),
+            'ice_password': json.dumps(ice_password),
+            'crop_left': 600 if video_crop.lower() == 'true' else 0,
+            'crop_right': 1320 if video_crop.lower() == 'true' else 1920,
+            'customized': 'true' if is_custom_avatar.lower() == 'true' else 'false',
+            'character': json.dumps(avatar_character),
+            'style': json.dumps(avatar_style),
+            'background_color': json.dumps('#00FF00FF' if transparent_background.lower() == 'true' else background_color)
         }
-        
+
         connection = speechsdk.Connection.from_speech_synthesizer(speech_synthesizer)
-        connection.set_message_property('speech.config', 'context', json.dumps(avatar_config))
+        connection.set_message_property('speech.config', 'context', avatar_config)
 
         speech_sythesis_result = speech_synthesizer.speak_text_async('').get()
         print(f'Result id for avatar connection: {speech_sythesis_result.result_id}')
@@ -204,13 +206,7 @@ def speak() -> Response:
 def getSpeakingStatus() -> Response:
     global client_contexts
     client_id = uuid.UUID(request.headers.get('ClientId'))
-    is_speaking = client_contexts[client_id]['is_speaking']
-    last_speak_time = client_contexts[client_id]['last_speak_time']
-    speaking_status = {
-        'isSpeaking': is_speaking,
-        'lastSpeakTime': last_speak_time.isoformat() if last_speak_time else None
-    }
-    return Response(json.dumps(speaking_status), status=200)
+    return Response(client_contexts[client_id]['speaking_status'], mimetype='application/json', status=200)
 
 # The API route to stop avatar from speaking
 @app.route("/api/stopSpeaking", methods=["POST"])
@@ -250,6 +246,12 @@ def disconnectAvatar() -> Response:
     client_id = uuid.UUID(request.headers.get('ClientId'))
     client_context = client_contexts[client_id]
     speech_synthesizer = client_context['speech_synthesizer']
+    # Stop the speaking thread, a new one is started with a new queue by the next speakWithQueue call
+    with speaking_thread_lock:
+        if client_context['speaking_thread'] is not None:
+            client_context['spoken_text_queue'].put(None)
+            client_context['spoken_text_queue'] = queue.Queue()
+            client_context['speaking_thread'] = None
     try:
         connection = speechsdk.Connection.from_speech_synthesizer(speech_synthesizer)
         connection.close()
@@ -267,32 +269,51 @@ def initializeClient() -> uuid.UUID:
         'custom_voice_endpoint_id': None, # Endpoint ID (deployment ID) for custom voice
         'personal_voice_speaker_profile_id': None, # Speaker profile ID for personal voice
         'speech_synthesizer': None, # Speech synthesizer for avatar
+        'ssml_template': None, # SSML template bound to the TTS voice and speaker profile, with {text} and {ending_silence_ms} placeholders
         'speech_token': None, # Speech token for client side authentication with speech service
         'ice_token': None, # ICE token for ICE/TURN/Relay server connection
         'chat_initiated': False, # Flag to indicate if the chat context is initiated
         'messages': [], # Chat messages (history)
         'data_sources': [], # Data sources for 'on your data' scenario
         'is_speaking': False, # Flag to indicate if the avatar is speaking
-        'spoken_text_queue': [], # Queue to store the spoken text
-        'speaking_thread': None, # The thread to speak the spoken text queue
-        'last_speak_time': None # The last time the avatar spoke
+        'spoken_text_queue': queue.Queue(), # Queue of the current speaking thread, to store the spoken text and its ending silence, None to stop the thread
+        'speaking_thread': None, # The long-lived thread to speak the spoken text queue
+        'last_speak_time': None, # The last time (time.time()) the avatar spoke
+        'speaking_status': b'{"isSpeaking": false, "lastSpeakTime": null}' # Speaking status JSON served to the client, updated when the status changes
     }
     return client_id
 
-# Refresh the ICE token which being called
-def refreshIceToken() -> None:
+# Fetch the ICE token, and return whether it succeeded
+def fetchIceToken() -> bool:
     global ice_token
-    if speech_private_endpoint:
-        ice_token = requests.get(f'{speech_private_endpoint}/tts/cognitiveservices/avatar/relay/token/v1', headers={'Ocp-Apim-Subscription-Key': speech_key}).text
-    else:
-        ice_token = requests.get(f'https://{speech_region}.tts.speech.microsoft.com/cognitiveservices/avatar/relay/token/v1', headers={'Ocp-Apim-Subscription-Key': speech_key}).text
+    global ice_token_parsed
+    try:
+        if speech_private_endpoint:
+            new_ice_token = requests.get(f'{speech_private_endpoint}/tts/cognitiveservices/avatar/relay/token/v1', headers={'Ocp-Apim-Subscription-Key': speech_key}).text
+        else:
+            new_ice_token = requests.get(f'https://{speech_region}.tts.speech.microsoft.com/cognitiveservices/avatar/relay/token/v1', headers={'Ocp-Apim-Subscription-Key': speech_key}).text
+        # Parse once here, so that avatar connections don't need to parse the token again
+        ice_token_obj = json.loads(new_ice_token)
+        ice_token_parsed = (ice_token_obj['Urls'][0], ice_token_obj['Username'], ice_token_obj['Password'])
+        ice_token = new_ice_token
+        return True
+    except Exception as e:
+        print(f"Error occurred while fetching the ICE token: {e}")
+        return False
+
+# Refresh the ICE token every hour, or retry after a minute if the last fetch failed. The first token is fetched at startup.
+def refreshIceToken(last_fetch_succeeded: bool) -> None:
+    while True:
+        time.sleep(60 * 60 if last_fetch_succeeded else 60)
+        last_fetch_succeeded = fetchIceToken()
 
 # Refresh the speech token every 9 minutes
 def refreshSpeechToken() -> None:
     global speech_token
     while True:
         # Refresh the speech token every 9 minutes
-        speech_token = requests.post(f'https://{speech_region}.api.cognitive.microsoft.com/sts/v1.0/issueToken', headers={'Ocp-Apim-Subscription-Key': speech_key}).text
+        speech_token = sts_session.post(f'https://{speech_region}.api.cognitive.microsoft.com/sts/v1.0/issueToken', headers={'Ocp-Apim-Subscription-Key': speech_key}).text
+        speech_token_ready.set()
         time.sleep(60 * 9)
 
 # Initialize the chat context, e.g. chat history (messages), data sources, etc. For chat scenario.
@@ -356,18 +377,12 @@ def handleUserQuery(user_query: str, client_id: uuid.UUID):
 
     # Stop previous speaking if there is any
     if is_speaking:
-        stopSpeakingInternal()
+        stopSpeakingInternal(client_id)
 
     # For 'on your data' scenario, chat API currently has long (4s+) latency
     # We return some quick reply here before the chat API returns to mitigate.
     if len(data_sources) > 0 and enable_quick_reply:
-        speak(random.choice(quick_replies), 2000)
-
-    url = f"{azure_openai_endpoint}/openai/deployments/{azure_openai_deployment_name}/chat/completions?api-version=2023-06-01-preview"
-    body = json.dumps({
-        'messages': messages,
-        'stream': True
-    })
+        speakWithQueue(random.choice(quick_replies), 2000, client_id)
 
     if len(data_sources) > 0:
         url = f"{azure_openai_endpoint}/openai/deployments/{azure_openai_deployment_name}/extensions/chat/completions?api-version=2023-06-01-preview"
@@ -376,76 +391,95 @@ def handleUserQuery(user_query: str, client_id: uuid.UUID):
             'messages': messages,
             'stream': True
         })
+    else:
+        url = f"{azure_openai_endpoint}/openai/deployments/{azure_openai_deployment_name}/chat/completions?api-version=2023-06-01-preview"
+        body = json.dumps({
+            'messages': messages,
+            'stream': True
+        })
 
     assistant_reply = ''
     tool_content = ''
     spoken_sentence = ''
+    pending_tokens = [] # Response tokens not yet yielded to client
+    pending_length = 0 # Total length of the pending tokens
+
+    # Bind globals used in the per-token loop below to locals, to avoid global lookups for every token
+    has_data_sources = len(data_sources) > 0
+    punctuations = sentence_level_punctuations
+    doc_regex = oyd_doc_regex
+    flush_size = chat_response_flush_size
+    speak_with_queue = speakWithQueue
+    json_loads = json.loads
+
+    with aoai_session.post(url, stream=True, headers=aoai_request_headers, data=body) as response:
+        if not response.ok:
+            raise Exception(f"Chat API response status: {response.status_code} {response.reason}")
+
+        # Iterate lines from the response stream, each event comes as a 'data:' line followed by an empty line
+        for line in response.iter_lines(chunk_size=None):
+            if not line.startswith(b'data:'):
+                continue
+
+            payload = line[5:].strip()
+            if payload == b'[DONE]':
+                # End of events, keep reading to the end of the stream so the connection is released back to the session pool
+                continue
 
-    response = requests.post(url, stream=True, headers={
-        'api-key': azure_openai_api_key,
-        'Content-Type': 'application/json'
-    }, data=body)
-
-    if not response.ok:
-        raise Exception(f"Chat API response status: {response.status_code} {response.reason}")
-
-    # Iterate chunks from the response stream
-    iterator = response.iter_content(chunk_size=None)
-    for chunk in iterator:
-        if not chunk:
-            # End of stream
-            return
-
-        # Process the chunk of data (value)
-        chunk_string = chunk.decode()
-
-        if not chunk_string.endswith('}\n\n') and not chunk_string.endswith('[DONE]\n\n'):
-            # This is an incomplete chunk, read the next chunk
-            while not chunk_string.endswith('}\n\n') and not chunk_string.endswith('[DONE]\n\n'):
-                chunk_string += next(iterator).decode()
-
-        for line in chunk_string.split('\n\n'):
             try:
-                if line.startswith('data:') and not line.endswith('[DONE]'):
-                    response_json = json.loads(line[5:].strip())
-                    response_token = None
-                    if len(response_json['choices']) > 0:
-                        choice = response_json['choices'][0]
-                        if len(data_sources) == 0:
-                            if len(choice['delta']) > 0 and 'content' in choice['delta']:
-                                response_token = choice['delta']['content']
-                        elif len(choice['messages']) > 0 and 'delta' in choice['messages'][0]:
-                            delta = choice['messages'][0]['delta']
-                            if 'role' in delta and delta['role'] == 'tool' and 'content' in delta:
-                                tool_content = response_json['choices'][0]['messages'][0]['delta']['content']
-                            elif 'content' in delta:
-                                response_token = response_json['choices'][0]['messages'][0]['delta']['content']
-                                if response_token is not None:
-                                    if oyd_doc_regex.search(response_token):
-                                        response_token = oyd_doc_regex.sub('', response_token).strip()
-                                    if response_token == '[DONE]':
-                                        response_token = None
-
-                    if response_token is not None:
-                        # Log response_token here if need debug
-                        yield response_token # yield response token to client as display text
-                        assistant_reply += response_token  # build up the assistant message
-                        if response_token == '\n' or response_token == '\n\n':
-                            speakWithQueue(spoken_sentence.strip(), 0, client_id)
+                response_json = json_loads(payload)
+                response_token = None
+                if len(response_json['choices']) > 0:
+                    choice = response_json['choices'][0]
+                    if not has_data_sources:
+                        response_token = choice['delta'].get('content')
+                    else:
+                        # Look up the delta once, and read role and content from it
+                        choice_messages = choice.get('messages')
+                        delta = choice_messages[0].get('delta', {}) if choice_messages else {}
+                        if delta.get('role') == 'tool' and 'content' in delta:
+                            tool_content = delta['content']
+                        elif 'content' in delta:
+                            response_token = delta['content']
+                            if response_token is not None:
+                                # Only run the regex when the token could contain a document reference
+                                if '[' in response_token:
+                                    cleaned_token, doc_reference_count = doc_regex.subn('', response_token)
+                                    if doc_reference_count > 0:
+                                        response_token = cleaned_token.strip()
+                                if response_token == '[DONE]':
+                                    response_token = None
+
+                if response_token is not None:
+                    # Log response_token here if need debug
+                    assistant_reply += response_token  # build up the assistant message
+                    pending_tokens.append(response_token)
+                    pending_length += len(response_token)
+                    sentence_ended = False
+                    if response_token == '\n' or response_token == '\n\n':
+                        speak_with_queue(spoken_sentence.strip(), 0, client_id)
+                        spoken_sentence = ''
+                        sentence_ended = True
+                    else:
+                        response_token = response_token.replace('\n', '')
+                        spoken_sentence += response_token  # build up the spoken sentence
+                        if (len(response_token) == 1 or len(response_token) == 2) and response_token[0] in punctuations:
+                            speak_with_queue(spoken_sentence.strip(), 0, client_id)
                             spoken_sentence = ''
-                        else:
-                            response_token = response_token.replace('\n', '')
-                            spoken_sentence += response_token  # build up the spoken sentence
-                            if len(response_token) == 1 or len(response_token) == 2:
-                                for punctuation in sentence_level_punctuations:
-                                    if response_token.startswith(punctuation):
-                                        speakWithQueue(spoken_sentence.strip(), 0, client_id)
-                                        spoken_sentence = ''
-                                        break
+                            sentence_ended = True
+
+                    # Yield the buffered tokens to client as display text, at sentence end (including tokens ending with punctuation) or when enough has been buffered
+                    if sentence_ended or response_token[-1:] in punctuations or pending_length >= flush_size:
+                        yield ''.join(pending_tokens)
+                        pending_tokens.clear()
+                        pending_length = 0
             except Exception as e:
                 print(f"Error occurred while parsing the response: {e}")
                 print(line)
 
+    if len(pending_tokens) > 0:
+        yield ''.join(pending_tokens)
+
     if spoken_sentence != '':
         speakWithQueue(spoken_sentence.strip(), 0, client_id)
         spoken_sentence = ''
@@ -463,56 +497,135 @@ def handleUserQuery(user_query: str, client_id: uuid.UUID):
     }
     messages.append(assistant_message)
 
+    # Trim the chat history to the most recent turns, so the request doesn't keep growing with the conversation
+    # The system message (if any) is always kept at the beginning
+    user_message_indices = [i for i, message in enumerate(messages) if message['role'] == 'user']
+    if len(user_message_indices) > max_chat_history_turns:
+        history_start_index = 1 if messages[0]['role'] == 'system' else 0
+        del messages[history_start_index:user_message_indices[-max_chat_history_turns]]
+
 # Speak the given text. If there is already a speaking in progress, add the text to the queue. For chat scenario.
 def speakWithQueue(text: str, ending_silence_ms: int, client_id: uuid.UUID) -> None:
     global client_contexts
     client_context = client_contexts[client_id]
-    spoken_text_queue = client_context['spoken_text_queue']
-    is_speaking = client_context['is_speaking']
-    spoken_text_queue.append(text)
-    if not is_speaking:
-        def speakThread():
-            nonlocal client_context
-            nonlocal spoken_text_queue
-            nonlocal ending_silence_ms
-            tts_voice = client_context['tts_voice']
-            personal_voice_speaker_profile_id = client_context['personal_voice_speaker_profile_id']
-            client_context['is_speaking'] = True
-            while len(spoken_text_queue) > 0:
-                text = spoken_text_queue.pop(0)
-                speakText(text, tts_voice, personal_voice_speaker_profile_id, ending_silence_ms, client_id)
-                client_context['last_speak_time'] = datetime.datetime.now(pytz.UTC)
+    with speaking_thread_lock:
+        spoken_text_queue = client_context['spoken_text_queue']
+        spoken_text_queue.put((text, ending_silence_ms))
+        # Start the speaking thread on first use, it then stays alive and waits for new text
+        if client_context['speaking_thread'] is None:
+            client_context['speaking_thread'] = threading.Thread(target=speakThread, args=(client_id, spoken_text_queue), daemon=True)
+            client_context['speaking_thread'].start()
+
+# The speaking thread, which keeps speaking the text from its own spoken text queue, until it gets None from the queue. For chat scenario.
+def speakThread(client_id: uuid.UUID, spoken_text_queue: queue.Queue) -> None:
+    global client_contexts
+    client_context = client_contexts[client_id]
+    speech_synthesis_futures = collections.deque() # Futures of the utterances submitted to the synthesizer, in speaking order
+    held_texts = collections.deque() # Texts got from the queue while the pipeline is full, dropped by stop speaking
+    handled_synthesizer = None # The synthesizer whose completion events are reported to this thread
+    stopping = False # Whether None has been got from the queue, the thread exits once the submitted utterances are done
+
+    # Report completed (or canceled) utterances through the queue, so that the thread keeps watching the queue for new text while speaking
+    def onSynthesisDone(evt) -> None:
+        spoken_text_queue.put(speech_synthesis_done_marker)
+
+    while True:
+        # The synthesizer speaks the submitted utterances in order, submitting the next one early avoids the gap between sentences
+        while len(held_texts) > 0 and len(speech_synthesis_futures) < speaking_pipeline_depth:
+            text, ending_silence_ms = held_texts.popleft()
+            try:
+                speech_synthesizer = client_context['speech_synthesizer']
+                if speech_synthesizer is not handled_synthesizer:
+                    speech_synthesizer.synthesis_completed.connect(onSynthesisDone)
+                    speech_synthesizer.synthesis_canceled.connect(onSynthesisDone)
+                    handled_synthesizer = speech_synthesizer
+                speech_synthesis_futures.append(startSpeakText(text, ending_silence_ms, client_id))
+            except Exception as e:
+                print(f"Error occurred while speaking the text: {e}")
+
+        if len(speech_synthesis_futures) == 0 and len(held_texts) == 0:
+            if stopping:
+                break
+            if spoken_text_queue.empty() and client_context['is_speaking']:
+                client_context['is_speaking'] = False
+                updateSpeakingStatus(client_context)
+
+        if stopping:
+            # No new text is taken after stopping, just wait for the submitted utterances
+            text_item = speech_synthesis_done_marker
+        else:
+            text_item = spoken_text_queue.get()
+
+        if text_item is None:
+            stopping = True
+            held_texts.clear()
+        elif text_item is speech_synthesis_done_marker:
+            if len(speech_synthesis_futures) > 0:
+                try:
+                    waitSpeakSsml(speech_synthesis_futures.popleft())
+                except Exception as e:
+                    print(f"Error occurred while speaking the text: {e}")
+                client_context['last_speak_time'] = time.time()
+                updateSpeakingStatus(client_context)
+        elif text_item is speaking_stopped_marker:
+            held_texts.clear()
+        else:
+            held_texts.append(text_item)
+            if not client_context['is_speaking']:
+                client_context['is_speaking'] = True
+                updateSpeakingStatus(client_context)
+
+    # Only clear the speaking status if no new speaking thread has taken over the client
+    with speaking_thread_lock:
+        if client_context['speaking_thread'] is None:
             client_context['is_speaking'] = False
-        client_context['speaking_thread'] = threading.Thread(target=speakThread)
-        client_context['speaking_thread'].start()
-
-# Speak the given text.
-def speakText(text: str, voice: str, speaker_profile_id: str, ending_silence_ms: int, client_id: uuid.UUID) -> str:
-    ssml = f"""<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='http://www.w3.org/2001/mstts' xml:lang='en-US'>
-                 <voice name='{voice}'>
-                     <mstts:ttsembedding speakerProfileId='{speaker_profile_id}'>
-                         <mstts:leadingsilence-exact value='0'/>
-                         {html.escape(text)}
-                     </mstts:ttsembedding>
-                 </voice>
-               </speak>"""
-    if ending_silence_ms > 0:
-        ssml = f"""<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='http://www.w3.org/2001/mstts' xml:lang='en-US'>
-                     <voice name='{voice}'>
-                         <mstts:ttsembedding speakerProfileId='{speaker_profile_id}'>
-                             <mstts:leadingsilence-exact value='0'/>
-                             {html.escape(text)}
-                             <break time='{ending_silence_ms}ms' />
-                         </mstts:ttsembedding>
-                     </voice>
-                   </speak>"""
-    return speakSsml(ssml, client_id)
+            updateSpeakingStatus(client_context)
+
+# Update the cached speaking status JSON, called when the speaking status changes rather than on every status query
+def updateSpeakingStatus(client_context: dict) -> None:
+    last_speak_time = client_context['last_speak_time']
+    client_context['speaking_status'] = json.dumps({
+        'isSpeaking': client_context['is_speaking'],
+        'lastSpeakTime': datetime.datetime.fromtimestamp(last_speak_time, datetime.timezone.utc).isoformat() if last_speak_time else None
+    }).encode('utf-8')
+
+# Build the SSML template for the given voice and speaker profile, leaving {text} and {ending_silence_ms} to be filled per utterance.
+def buildSsmlTemplate(voice: str, speaker_profile_id: str) -> str:
+    voice = str(voice).replace('{', '{{').replace('}', '}}')
+    speaker_profile_id = str(speaker_profile_id).replace('{', '{{').replace('}', '}}')
+    return ("<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xmlns:mstts='http://www.w3.org/2001/mstts' xml:lang='en-US'>"
+                f"<voice name='{voice}'>"
+                    f"<mstts:ttsembedding speakerProfileId='{speaker_profile_id}'>"
+                        "<mstts:leadingsilence-exact value='0'/>"
+                        "{text}"
+                        "<break time='{ending_silence_ms}ms' />"
+                    "</mstts:ttsembedding>"
+                "</voice>"
+            "</speak>")
+
+# Render the SSML for the given text. Cached, as quick replies and short sentences recur across utterances and sessions.
+@functools.lru_cache(maxsize=256)
+def renderSsml(ssml_template: str, text: str, ending_silence_ms: int) -> str:
+    return ssml_template.format(text=html.escape(text), ending_silence_ms=ending_silence_ms)
+
+# Start speaking the given text, without waiting for it to complete. A 0ms ending break is a no-op, so the same template serves both with and without ending silence.
+def startSpeakText(text: str, ending_silence_ms: int, client_id: uuid.UUID) -> speechsdk.ResultFuture:
+    ssml_template = client_contexts[client_id]['ssml_template']
+    return startSpeakSsml(renderSsml(ssml_template, text, ending_silence_ms), client_id)
 
 # Speak the given ssml with speech sdk
 def speakSsml(ssml: str, client_id: uuid.UUID) -> str:
+    return waitSpeakSsml(startSpeakSsml(ssml, client_id))
+
+# Start speaking the given ssml with speech sdk, without waiting for it to complete
+def startSpeakSsml(ssml: str, client_id: uuid.UUID) -> speechsdk.ResultFuture:
     global client_contexts
     speech_synthesizer = client_contexts[client_id]['speech_synthesizer']
-    speech_sythesis_result = speech_synthesizer.speak_ssml_async(ssml).get()
+    return speech_synthesizer.speak_ssml_async(ssml)
+
+# Wait for the speaking started by startSpeakSsml to complete, and return the result id
+def waitSpeakSsml(speech_sythesis_future: speechsdk.ResultFuture) -> str:
+    speech_sythesis_result = speech_sythesis_future.get()
     if speech_sythesis_result.reason == speechsdk.ResultReason.Canceled:
         cancellation_details = speech_sythesis_result.cancellation_details
         print(f"Speech synthesis canceled: {cancellation_details.reason}")
@@ -524,8 +637,21 @@ def speakSsml(ssml: str, client_id: uuid.UUID) -> str:
 # Stop speaking internal function
 def stopSpeakingInternal(client_id: uuid.UUID) -> None:
     global client_contexts
-    spoken_text_queue = client_contexts[client_id]['spoken_text_queue']
-    spoken_text_queue.clear()
+    client_context = client_contexts[client_id]
+    spoken_text_queue = client_context['spoken_text_queue']
+    # Drop the queued texts, and put back the completion markers, which the speaking thread still waits for
+    completion_markers = []
+    while True:
+        try:
+            text_item = spoken_text_queue.get_nowait()
+        except queue.Empty:
+            break
+        if text_item is speech_synthesis_done_marker:
+            completion_markers.append(text_item)
+    for completion_marker in completion_markers:
+        spoken_text_queue.put(completion_marker)
+    # Also drop the texts the speaking thread already got but not yet submitted
+    spoken_text_queue.put(speaking_stopped_marker)
     # To-do: also stop the current speaking by synthesizer, after stop speaking is supported by SDK
 
 # Start the speech token refresh thread
@@ -533,5 +659,7 @@ speechTokenRefereshThread = threading.Thread(target=refreshSpeechToken)
 speechTokenRefereshThread.daemon = True
 speechTokenRefereshThread.start()
 
-# Fetch ICE token at startup
-refreshIceToken()
+# Fetch ICE token at startup, and start the ICE token refresh thread
+iceTokenRefreshThread = threading.Thread(target=refreshIceToken, args=(fetchIceToken(),))
+iceTokenRefreshThread.daemon = True
+iceTokenRefreshThread.start()